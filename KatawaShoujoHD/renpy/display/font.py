@@ -60,7 +60,20 @@ class ImageFont(object):
 
         xoff, _ = self.offsets[text[0]]
         w = -xoff
-        
+
+        # Without per-pair kerns, the width is just the sum of the
+        # advances, so there's no need to walk the pairs.
+        if not self.kerns:
+            try:
+                w += sum([ self.advance[a] for a in text[:-1] ])
+            except KeyError, e:
+                raise Exception("Character %r not found in %s." % (e.args[0], type(self).__name__))
+
+            w += self.default_kern * (len(text) - 1)
+            w += self.width[text[-1]]
+
+            return (w, self.height)
+
         for a, b in zip(text, text[1:]):
             try:
                 w += self.advance[a] + self.kerns.get(a + b, self.default_kern)
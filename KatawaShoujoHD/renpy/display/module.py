@@ -211,6 +211,23 @@ def alpha_munge(src, dst, amap):
         _renpy.alpha_munge(src, dst, red, alpha, amap)        
 
 
+def alpha_map(src, dst, amap):
+    """
+    This maps the alpha channel of src through amap, and places it
+    into the alpha channel of dst. The color channels of dst are left
+    alone. src and dst may be the same surface.
+    """
+
+    if src.get_size() != dst.get_size():
+        return
+
+    src_alpha = byte_offset(src)[3]
+    dst_alpha = byte_offset(dst)[3]
+
+    if src_alpha is not None and dst_alpha is not None:
+        _renpy.alpha_munge(src, dst, src_alpha, dst_alpha, amap)
+
+
 def bilinear_scale(src, dst, sx=0, sy=0, sw=None, sh=None, dx=0, dy=0, dw=None, dh=None, precise=0):
 
     if sw is None:
@@ -22,6 +22,7 @@
 import re
 import renpy
 import sys
+import itertools
 
 from _renpybidi import log2vis, WRTL, RTL, ON
     
@@ -49,6 +50,14 @@ text_tags = dict(
     )
 
 text_tags[""] = True
+
+# The text tags that control pausing, and the prefixes of those that
+# take an argument.
+pause_tags = set([ "p", "nw", "fast", "w" ])
+pause_tag_prefixes = set([ "p=", "w=" ])
+
+# A map from a hex digit to its value, used by color().
+hex_digits = dict((c, int(c, 16)) for c in "0123456789abcdefABCDEF")
        
 def color(s):
     """
@@ -62,43 +71,124 @@ def color(s):
     color('c0c0c0') returns (192, 192, 192, 255).
     """
 
-    if s[0] == '#':
+    if s[:1] == '#':
         s = s[1:]
 
-    if len(s) == 6:
-        r = int(s[0]+s[1], 16)
-        g = int(s[2]+s[3], 16)
-        b = int(s[4]+s[5], 16)
-        a = 255
-    elif len(s) == 8:
-        r = int(s[0]+s[1], 16)
-        g = int(s[2]+s[3], 16)
-        b = int(s[4]+s[5], 16)
-        a = int(s[6]+s[7], 16)
-    elif len(s) == 3:
-        r = int(s[0], 16) * 0x11
-        g = int(s[1], 16) * 0x11
-        b = int(s[2], 16) * 0x11
-        a = 255
-    elif len(s) == 4:
-        r = int(s[0], 16) * 0x11
-        g = int(s[1], 16) * 0x11
-        b = int(s[2], 16) * 0x11
-        a = int(s[3], 16) * 0x11
-    else:
-        raise Exception("Argument to color() must be 3, 4, 6, or 8 hex digits long.")
+    h = hex_digits
+
+    try:
+        if len(s) == 6:
+            r = (h[s[0]] << 4) | h[s[1]]
+            g = (h[s[2]] << 4) | h[s[3]]
+            b = (h[s[4]] << 4) | h[s[5]]
+            a = 255
+        elif len(s) == 8:
+            r = (h[s[0]] << 4) | h[s[1]]
+            g = (h[s[2]] << 4) | h[s[3]]
+            b = (h[s[4]] << 4) | h[s[5]]
+            a = (h[s[6]] << 4) | h[s[7]]
+        elif len(s) == 3:
+            r = h[s[0]] * 0x11
+            g = h[s[1]] * 0x11
+            b = h[s[2]] * 0x11
+            a = 255
+        elif len(s) == 4:
+            r = h[s[0]] * 0x11
+            g = h[s[1]] * 0x11
+            b = h[s[2]] * 0x11
+            a = h[s[3]] * 0x11
+        else:
+            raise Exception("Argument to color() must be 3, 4, 6, or 8 hex digits long.")
+    except KeyError:
+        raise ValueError("Argument to color() must only contain hex digits: %r" % s)
 
     return (r, g, b, a)
 
+# This contains a map from the font parameters, text, and colors of a
+# piece of text to the (surface, size) it was rendered to. It's shared
+# between TextStyles, so text that's rendered the same way is reused
+# between Text widgets and layouts.
+surface_cache = { }
+
+# This contains a map from font parameters to a map from text to the
+# width of that text. TextStyles with the same font share a width map.
+width_cache = { }
+
+def free_memory():
+    """
+    Clears the surface and width caches.
+    """
+
+    surface_cache.clear()
+    width_cache.clear()
+
+# A map from an alpha value to a table that scales the alpha channel of
+# a surface by that value.
+alpha_tables = { }
+
+def alpha_table(a):
+    """
+    Returns a table, suitable for use with module.alpha_map, that scales
+    alpha by (a + 1) / 256. This matches what linmap does with a + 1.
+    """
+
+    rv = alpha_tables.get(a, None)
+    if rv is None:
+        rv = "".join([ chr((i * (a + 1)) >> 8) for i in range(256) ])
+        alpha_tables[a] = rv
+
+    return rv
+
+# The kinds of style that can be found in a laid-out line. Each style
+# class has a kind field giving one of these, which is cheaper to check
+# than isinstance.
+TEXT_KIND = 0
+SPACER_KIND = 1
+WIDGET_KIND = 2
+
 class TextStyle(object):
     """
     This is used to represent the style of text that will be displayed
     on the screen.
     """
 
+    kind = TEXT_KIND
+
+    __slots__ = [
+        'font',
+        'size',
+        'bold',
+        'italic',
+        'underline',
+        'strikethrough',
+        'color',
+        'black_color',
+        'hyperlink',
+        'f',
+        'fkey',
+        'wcache',
+        'ascent',
+        'height',
+        'skey',
+        ]
+    
     def __init__(self, source=None):
         if source is not None:
-            vars(self).update(vars(source))
+            self.font = source.font
+            self.size = source.size
+            self.bold = source.bold
+            self.italic = source.italic
+            self.underline = source.underline
+            self.strikethrough = source.strikethrough
+            self.color = source.color
+            self.black_color = source.black_color
+            self.hyperlink = source.hyperlink
+
+            self.f = source.f
+            self.fkey = source.fkey
+            self.wcache = source.wcache
+            self.ascent = source.ascent
+            self.height = source.height
         else:
             self.font = ""
             self.size = 0
@@ -110,35 +200,64 @@ class TextStyle(object):
             self.black_color = None
             self.hyperlink = None
 
-            # The cached font.
-        self.f = None
+            # The cached font, and the parameters it was loaded with.
+            self.f = None
+            self.fkey = None
             
-        # Width cache.
-        self.wcache = { }
+            # Width cache, shared with other styles that use the same font.
+            self.wcache = None
+
+            # The ascent of the font, and the height of a line of text
+            # in it.
+            self.ascent = 0
+            self.height = 0
 
-        # Surface cache.
-        self.scache = { }
+        # The part of the surface cache key that comes from this style.
+        self.skey = None
         
     def update(self):
-        self.f = get_font(self.font, self.size, self.bold, self.italic, self.underline, 0)
+        fkey = (self.font, self.size, self.bold, self.italic, self.underline)
+
+        # Tags like color don't change the font, so there's no need to
+        # look it up again.
+        if fkey != self.fkey:
+            self.f = get_font(self.font, self.size, self.bold, self.italic, self.underline, 0)
+            self.fkey = fkey
+            self.ascent = self.f.get_ascent()
+            self.height = self.ascent - self.f.get_descent()
+
+            self.wcache = width_cache.get(fkey, None)
+            if self.wcache is None:
+                self.wcache = width_cache[fkey] = { }
+
+        self.skey = fkey + (self.strikethrough, )
 
     def get_font(self):
         return self.f
 
     def get_ascent(self):
-        return self.f.get_ascent()
+        return self.ascent
 
     def get_width(self, text):
 
+        if not text:
+            return 0
+
         rv = self.wcache.get(text, None)
         if rv is None:
             rv = self.f.size(text)[0]
-            self.wcache[rv] = text
+
+            # Keep the cache from growing without bound.
+            if len(self.wcache) > 4096:
+                self.wcache.clear()
+
+            self.wcache[text] = rv
+
         return rv
 
     def sizes(self, text):
 
-        return self.get_width(text), self.f.get_ascent() - self.f.get_descent()
+        return self.get_width(text), self.height
 
     def render(self, text, antialias, color, black_color, use_colors, time, at, expand, use_cache):
         
@@ -146,10 +265,12 @@ class TextStyle(object):
             color = self.color or color
             black_color = self.black_color or black_color
 
-        key = (text, antialias, color, black_color, expand)
+        key = self.skey + (text, antialias, color, black_color, expand)
         
-        if use_cache and key in self.scache:
-            return self.scache[key]
+        if use_cache:
+            rv = surface_cache.get(key, None)
+            if rv is not None:
+                return rv
             
         if expand:
             font = get_font(self.font, self.size, self.bold, self.italic, self.underline, expand)
@@ -159,32 +280,35 @@ class TextStyle(object):
         if isinstance(font, ImageFont):
             rv = font.render(text, antialias, color, black_color)
             
-            if self.strikethrough:
-                sw, sh = rv.get_size()
-                soh = max(sh / 10, 1) 
-                rv.subsurface((0, sh / 2, sw, soh)).fill(color) 
-            
         else:
             r, g, b, a = color
-            color = (r, g, b, 255)
 
-            surf = font.render(text, antialias, color)
+            surf = font.render(text, antialias, (r, g, b, 255))
             rv = renpy.display.pgrender.copy_surface(surf)
             
-            if self.strikethrough:
-                sw, sh = surf.get_size()
-                soh = max(sh / 10, 1) 
-                rv.subsurface((0, sh / 2, sw, soh)).fill(color) 
-
             if a != 255:
-                renpy.display.module.linmap(rv, rv, 256, 256, 256, a + 1)
+                renpy.display.module.alpha_map(rv, rv, alpha_table(a))
+
+        # The strikethrough is drawn once the alpha has been applied, in
+        # its final color, so those pixels are only written once.
+        if self.strikethrough:
+            sw, sh = rv.get_size()
+            soh = max(sh / 10, 1) 
+            rv.subsurface((0, sh / 2, sw, soh)).fill(color) 
 
         renpy.display.render.mutated_surface(rv)
+
+        rv = (rv, rv.get_size())
         
         if use_cache and not renpy.game.less_memory:
-            self.scache[key] = (rv, rv.get_size())
+
+            # Keep the cache from growing without bound.
+            if len(surface_cache) > 512:
+                surface_cache.clear()
+
+            surface_cache[key] = rv
         
-        return rv, rv.get_size()
+        return rv
 
     def length(self, text):
         return len(text)
@@ -194,6 +318,8 @@ class WidgetStyle(object):
     Represents the style of a widget.
     """
 
+    kind = WIDGET_KIND
+
     def __init__(self, ts, widget, width, time):
 
         self.height = ts.sizes(" ")[1]
@@ -233,6 +359,8 @@ class WidgetStyle(object):
 
 class SpacerStyle(object):
 
+    kind = SPACER_KIND
+
     def update(self):
         pass
     
@@ -289,6 +417,15 @@ eastasian_text_regexp = ur"""(?x)
 
 eastasian_text_regexp = re.compile(eastasian_text_regexp)
 
+# A map from the name of a group in the tokenizer regexps to the kind of
+# token it produces.
+token_kinds = dict(
+    space='space',
+    word='word',
+    tag='tag',
+    newline='newline',
+    )
+
 def text_tokenizer(s, style):
     """
     This functions is used to tokenize text. It's called when laying
@@ -313,7 +450,15 @@ def text_tokenizer(s, style):
     """
 
     if style is None or style.language == "western":
+
+        if isinstance(s, unicode):
+            for i in western_text_tokenizer(s):
+                yield i
+
+            return
+
         regexp = western_text_regexp
+
     elif style.language == "eastasian":
         regexp = eastasian_text_regexp
     else:
@@ -321,17 +466,116 @@ def text_tokenizer(s, style):
 
     for m in regexp.finditer(s):
 
-        if m.group('space'):
-            yield 'space', m.group('space')
-        elif m.group('word'):
-            yield 'word', m.group('word')
-        elif m.group('tag'):
-            yield 'tag', m.group('tag')
-        elif m.group('untag'):
+        kind = m.lastgroup
+
+        if kind == 'untag':
             yield 'word', '{'
-        elif m.group('newline'):
-            yield 'newline', m.group('newline')
+        else:
+            # The group names aren't interned, so map them back to the
+            # interned literals that later passes compare against.
+            yield token_kinds[kind], m.group(kind)
+
+
+def western_text_tokenizer(s):
+    """
+    Tokenizes unicode text in the same way as western_text_regexp, but
+    uses find to locate the end of each word rather than running the
+    regular expression.
+    """
+
+    find = s.find
+    l = len(s)
+
+    # The next space, newline, and open brace at or after pos, or l if
+    # there isn't one.
+    next_space = -1
+    next_newline = -1
+    next_brace = -1
+
+    pos = 0
+
+    while pos < l:
+
+        c = s[pos]
+
+        if c == u' ' or c == u'\u200b':
+            yield 'space', c
+            pos += 1
+            continue
+
+        if c == u'\n':
+            yield 'newline', c
+            pos += 1
+            continue
+
+        if next_brace < pos:
+            next_brace = find(u'{', pos)
+            if next_brace == -1:
+                next_brace = l
+
+        if c == u'{':
+
+            if s[pos + 1:pos + 2] == u'{':
+                yield 'word', '{'
+                pos += 2
+                continue
+
+            next_brace = find(u'{', pos + 1)
+            if next_brace == -1:
+                next_brace = l
+
+            close = find(u'}', pos + 1, next_brace)
+
+            if close > pos + 1:
+                yield 'tag', s[pos + 1:close]
+                pos = close + 1
+            else:
+                # An unmatched brace is dropped.
+                pos += 1
+
+            continue
+
+        if next_space < pos:
+            next_space = find(u' ', pos)
+            if next_space == -1:
+                next_space = l
+
+        if next_newline < pos:
+            next_newline = find(u'\n', pos)
+            if next_newline == -1:
+                next_newline = l
+
+        end = min(next_space, next_newline, next_brace)
+
+        yield 'word', s[pos:end]
+        pos = end
+
+
+# This contains a map from (tokenizer, language, type, string) to a tuple
+# of the tokens that the tokenizer produced for that string.
+tokenizer_cache = { }
+
+def cached_tokenize(s, style):
+    """
+    Tokenizes s using renpy.config.text_tokenizer, returning a tuple of
+    tokens. The result is cached, so re-tokenizing the same string is
+    cheap.
+    """
+
+    tokenizer = renpy.config.text_tokenizer
+    key = (tokenizer, style.language, type(s), s)
+
+    rv = tokenizer_cache.get(key, None)
+    if rv is None:
+        rv = tuple(tokenizer(s, style))
 
+        # Keep the cache from growing without bound.
+        if len(tokenizer_cache) > 1024:
+            tokenizer_cache.clear()
+
+        tokenizer_cache[key] = rv
+
+    return rv
                 
 def input_tokenizer(l, style, pauses=None):
     """
@@ -348,7 +592,7 @@ def input_tokenizer(l, style, pauses=None):
     for s in l:
 
         if isinstance(s, basestring):
-            sl = renpy.config.text_tokenizer(s, style)
+            sl = cached_tokenize(s, style)
             rv.append(sl)
 
         elif isinstance(s, renpy.display.core.Displayable):
@@ -360,47 +604,195 @@ def input_tokenizer(l, style, pauses=None):
     return rv
 
 
+# This matches characters that log2vis might reorder or reshape: those
+# in right-to-left scripts, the explicit direction marks, and any
+# character outside the BMP (which may be in a right-to-left script). On
+# narrow builds, those are stored as surrogates.
+bidi_chars = ur'\u0590-\u08ff\u200f\u202a-\u202e\u2066-\u2069\ud800-\udfff\ufb1d-\ufdff\ufe70-\ufefe'
+
+if sys.maxunicode > 0xffff:
+    bidi_chars += u'\U00010000-\U0010ffff'
+
+bidi_regexp = re.compile(u'[' + bidi_chars + u']')
+needs_bidi = bidi_regexp.search
+
+class LineWidth(object):
+    """
+    This incrementally computes the width of a line of triples. Runs
+    of text with the same style are measured together, so the result
+    is the same as measuring the whole line at once.
+    """
+
+    def __init__(self, justify=False):
+        self.justify = justify
+        self.rtl = renpy.config.rtl
+
+        # The width of the runs that have been finished.
+        self.rv = 0
+
+        # The style and text of the run we're currently building.
+        self.curts = None
+        self.cur = ""
+
+        # The measured width of the run, the sum of the widths of the
+        # pieces added since it was measured, and the number of those
+        # pieces.
+        self.curw = 0
+        self.extra = 0
+        self.joins = 0
+
+        # How far off the sum of the widths of two pieces of text can be
+        # from the width of the two joined together. (Due to kerning
+        # and overhang.)
+        self.slack = 0
+
+    def copy(self):
+        rv = LineWidth(self.justify)
+        rv.rv = self.rv
+        rv.curts = self.curts
+        rv.cur = self.cur
+        rv.curw = self.curw
+        rv.extra = self.extra
+        rv.joins = self.joins
+        rv.slack = self.slack
+        return rv
+
+    def start_run(self, ts, i):
+        self.curts = ts
+        self.cur = i
+
+        w, self.slack = ts.sizes(i)
+
+        if self.rtl:
+            w = measure_run(ts, i)
+
+        self.curw = w
+        self.extra = 0
+        self.joins = 0
+
+    def run_width(self):
+        """
+        Returns the exact width of the current run.
+        """
+
+        if self.joins:
+            self.curw = measure_run(self.curts, self.cur)
+            self.extra = 0
+            self.joins = 0
+
+        return self.curw
+        
+    def add(self, type, ts, i):
+        """
+        Adds a single triple to the end of the line.
+        """
+
+        if ts is not self.curts:
+            if self.cur:
+                self.rv += self.run_width()
+
+            self.start_run(ts, i)
+
+        elif self.justify and type == "space":
+            self.rv += measure_run(self.curts, self.cur + i)
+            self.start_run(ts, "")
+
+        elif not self.cur:
+            self.start_run(ts, i)
+            
+        else:
+            self.cur += i
+
+            if not self.rtl:
+                self.extra += ts.get_width(i)
+                
+            self.joins += 1
+
+    def width(self):
+        """
+        Returns the width of the line so far.
+        """
+
+        if self.curts:
+            return self.rv + self.run_width()
+
+        return self.rv
+
+    def fits(self, target):
+        """
+        Returns True if the line is no wider than target. 
+
+        When the current run has grown since it was last measured, its
+        width is first estimated from the widths of the pieces that make
+        it up. Only if the estimate is too close to target to be sure
+        is the run measured.
+        """
+
+        if self.joins and not self.rtl:
+            estimate = self.rv + self.curw + self.extra
+            slack = self.joins * self.slack
+
+            if estimate + slack <= target:
+                return True
+
+            if estimate - slack > target:
+                return False
+
+        return self.width() <= target
+
+        
+def line_needs_bidi(styles, texts):
+    """
+    Returns True if any of the text in a line, given as parallel lists
+    of styles and text, needs to be reordered by log2vis.
+    """
+
+    for ts, i in zip(styles, texts):
+        if ts.kind == TEXT_KIND and needs_bidi(i):
+            return True
+
+    return False
+
+def measure_run(ts, text):
+    """
+    Returns the width of a run of text that shares the text style ts.
+    """
+
+    if renpy.config.rtl and needs_bidi(text):
+        text, dir = log2vis(text, ON)
+
+    return ts.get_width(text)
+
+
 def layout_width(triples, justify=False):
     """
-    Returns the width of the given list of triples. 
+    Returns the width of the given list of triples. Each run of text
+    that shares a style is measured as a whole.
     """
 
     rv = 0
 
     curts = None
-    cur = ""
+    parts = [ ]
 
-    rtl = renpy.config.rtl
-    
     for type, ts, i in triples:
         if ts is not curts:
-            if cur:
-
-                if rtl:
-                    cur, dir = log2vis(cur, ON)
-
-                rv += curts.get_width(cur)
+            if parts:
+                rv += measure_run(curts, join_parts(parts))
                 
             curts = ts
-            cur = i
+            parts = [ i ]
 
         elif justify and type == "space":
-            cur += i
-
-            if rtl:
-                cur, dir = log2vis(cur, ON)
-
-            rv += curts.get_width(cur)
-            cur = ""
+            parts.append(i)
+            rv += measure_run(curts, join_parts(parts))
+            parts = [ ]
 
         else:
-            cur += i
+            parts.append(i)
 
     if curts:
-        if rtl:
-            cur, dir = log2vis(cur, ON)
-
-        rv += curts.get_width(cur)
+        rv += measure_run(curts, join_parts(parts))
 
     return rv
     
@@ -429,6 +821,9 @@ def greedy_text_layout(triples, width, style):
     justify = style.justify
     
     after_newline = True
+
+    # The width of the current line, updated as triples are added.
+    lw = LineWidth(justify)
     
     for triple in triples:
 
@@ -438,6 +833,7 @@ def greedy_text_layout(triples, width, style):
             lines.append(line)
             lines_last.append(True) 
             line = [ ]
+            lw = LineWidth(justify)
             target = width - style.rest_indent
 
             after_newline = True
@@ -448,20 +844,27 @@ def greedy_text_layout(triples, width, style):
             if not line and not after_newline:
                 continue
             line.append(triple)
+            lw.add(type, ts, i)
             continue
 
         else:
 
             after_newline = False
+
+            newlw = lw.copy()
+            newlw.add(type, ts, i)
             
-            if layout_width(line + [ triple ], justify) > target:
+            if not newlw.fits(target):
 
                 lines.append(line)
                 lines_last.append(False)
                 line = [ triple ]
+                lw = LineWidth(justify)
+                lw.add(type, ts, i)
                 target = width - style.rest_indent
             else:
                 line.append(triple)
+                lw = newlw
 
     lines.append(line)
     lines_last.append(True)
@@ -485,6 +888,9 @@ def subtitle_text_layout_core(triples, width, style, soft, n, justify):
     total = soft * n
     linesoft = total / n
 
+    # The width of the current line.
+    linewidth = LineWidth(justify)
+    
     for triple in triples:
 
         type, ts, i = triple
@@ -493,11 +899,14 @@ def subtitle_text_layout_core(triples, width, style, soft, n, justify):
             if not line:
                 continue
             line.append(triple)
+            linewidth.add(type, ts, i)
             continue
 
         else:
 
-            lw = layout_width(line + [ triple ], justify)
+            newwidth = linewidth.copy()
+            newwidth.add(type, ts, i)
+            lw = newwidth.width()
 
             if lw > target or type == "newline":
 
@@ -515,13 +924,17 @@ def subtitle_text_layout_core(triples, width, style, soft, n, justify):
                 lines.append(line)
                 target = width
 
+                linewidth = LineWidth(justify)
+                
                 if type == "newline":
                     line = [ ]
                 else:
                     line = [ triple ]
+                    linewidth.add(type, ts, i)
 
             else:
                 line.append(triple)
+                linewidth = newwidth
 
                 if lw > linesoft:
 
@@ -534,6 +947,7 @@ def subtitle_text_layout_core(triples, width, style, soft, n, justify):
 
                     lines.append(line)
                     line = [ ]
+                    linewidth = LineWidth(justify)
                     target = width
 
     lines.append(line)
@@ -550,6 +964,9 @@ def subtitle_text_layout_core(triples, width, style, soft, n, justify):
     return lines
 
 
+def is_newline(triple):
+    return triple[0] == "newline"
+
 def subtitle_text_layout(triples, width, style):
 
     justify = style.justify
@@ -558,43 +975,56 @@ def subtitle_text_layout(triples, width, style):
     if isinstance(softwidth, float):
         softwidth = int(softwidth * width)
 
-    # Split things up into paragraphs.
+    # Split things up into paragraphs. Each newline starts a new
+    # paragraph, even if it's empty.
     pars = [ [ ] ]
 
-    for tup in triples:
-        if tup[0] == "newline":
-            pars.append([])
-            continue
-
-        pars[-1].append(tup)
-
+    for newline, group in itertools.groupby(triples, is_newline):
+        if newline:
+            for tup in group:
+                pars.append([ ])
+        else:
+            pars[-1].extend(group)
 
     # Deal with each paragraph separately.
     lines = [ ]
     lines_last = [ ]
         
     for triples in pars:
-        x = 0
-        newtriples = []
-        while x<len(triples):
-            triplewidth = layout_width([triples[x],],justify)
-            if triplewidth<=width or triples[x][0]!='word':
-                newtriples.append(triples[x])
+
+        # Break words that are too wide for a line into characters.
+        newtriples = [ ]
+
+        for tup in triples:
+            type, ts, i = tup
+
+            if type == 'word' and measure_run(ts, i) > width:
+                newtriples.extend([ ('word', ts, char) for char in i ])
             else:
-                for char in triples[x][2]:
-                    newtriples.append(('word',triples[x][1],char))
-            x+=1
+                newtriples.append(tup)
+
         triples = newtriples
 
         sumwidths = layout_width(triples, justify)
+        maxwidth = min(width, softwidth)
 
-        i = 1
-        while sumwidths / i > min(width, softwidth):
+        # Start from the smallest number of lines that the average
+        # line width can fit into, rather than counting up from 1.
+        if maxwidth >= 0:
+            i = max(1, int(sumwidths // (maxwidth + 1)) + 1)
+        else:
+            i = 1
+
+        while sumwidths / i > maxwidth:
             i += 1
 
+        # The core can't produce more lines than there are triples, so
+        # once i passes that, asking for more lines won't help.
+        maxlines = len(triples) + 1
+            
         while True:
             rv = subtitle_text_layout_core(triples, width, style, sumwidths / i, i, justify)
-            if len(rv) == i:
+            if len(rv) == i or i >= maxlines:
                 break
             i += 1
             
@@ -606,11 +1036,192 @@ def subtitle_text_layout(triples, width, style):
     return lines, lines_last
 
 def text_layout(triples, width, style):
+    """
+    This is the default value of config.text_layout. It's called to
+    break text up into lines, and is given a list of triples, the width
+    to lay out to, and the style of the Text widget.
+
+    Each triple is a (kind, style, text) tuple. The following kinds are
+    defined:
+
+    "word" -- A word of text, or a widget (in which case the style is
+    a WidgetStyle, and the text is the widget).
+
+    "space" -- A space.
+
+    "newline" -- A forced line break. The text is empty.
+
+    "start" -- The place where slow text starts. The text is empty.
+
+    It's expected to return a pair of lists. The first is a list of
+    lines, where each line is a list of triples. The second gives, for
+    each line, True if that line is the last line of a paragraph.
+    """
 
     if style.layout == "subtitle":
         return subtitle_text_layout(triples, width, style)
+
+    # Most text (names, buttons, menu choices) fits on a single line,
+    # in which case there's no need to break it up.
+    lw = LineWidth(style.justify)
+
+    for type, ts, i in triples:
+        if type == "newline":
+            break
+
+        lw.add(type, ts, i)
+
+    else:
+        if lw.fits(width - style.first_indent):
+            return [ list(triples) ], [ True ]
+        
+    return greedy_text_layout(triples, width, style)
+
+
+def join_parts(parts):
+    """
+    Joins together the pieces of a span. A span with a single piece may
+    be a widget, which is returned as-is.
+    """
+
+    if len(parts) == 1:
+        return parts[0]
+
+    return "".join(parts)
+
+def coalesce_line(triples, justify):
+    """
+    Turns a line of (kind, style, text) triples into the spans that are
+    rendered, joining together adjacent triples that share a style. When
+    justify is true, a SpacerStyle is placed after each space.
+
+    Returns a tuple giving the list of the styles of the spans, the
+    matching list of their text, the length of the line, and the offset
+    into the line where slow text starts, or None if it doesn't start on
+    this line.
+    """
+
+    styles = [ ]
+    texts = [ ]
+    length = 0
+    start = None
+    
+    oldts = None
+
+    # The pieces of the span we're building. These are joined when the
+    # span is finished, rather than being added one at a time.
+    parts = [ ]
+            
+    for kind, ts, i in triples:
+
+        if kind == "start":
+            start = length
+            continue
+
+        if ts.kind == TEXT_KIND:
+            length += len(i)
+        else:
+            length += ts.length(i)
+                    
+        if ts is not oldts:
+            if oldts is not None:
+                styles.append(oldts)
+                texts.append(join_parts(parts))
+
+            oldts = ts
+            parts = [ i ]
+        else:
+            parts.append(i)
+
+        if justify and kind == "space":
+            cur = join_parts(parts)
+            if cur:
+                styles.append(oldts)
+                texts.append(cur)
+            parts = [ ]
+            styles.append(SpacerStyle())
+            texts.append("")
+                    
+    if oldts:
+        styles.append(oldts)
+        texts.append(join_parts(parts))
+
+    return styles, texts, length, start
+
+
+# The kinds of token that contain text, and so count towards the length
+# of the text by their own length.
+text_token_kinds = set([ "newline", "word", "space" ])
+
+# Handlers for the text tags that change the style of the text that
+# follows them. Each is given the TextStyle to change.
+
+def bold_tag(ts):
+    ts.bold = True
+
+def italic_tag(ts):
+    ts.italic = True
+
+def underline_tag(ts):
+    ts.underline = True
+
+def strikethrough_tag(ts):
+    ts.strikethrough = True
+
+def plain_tag(ts):
+    ts.bold = False
+    ts.italic = False
+    ts.underline = False
+
+# A map from the name of a tag that takes no argument to its handler.
+simple_tags = {
+    "b" : bold_tag,
+    "i" : italic_tag,
+    "u" : underline_tag,
+    "s" : strikethrough_tag,
+    "plain" : plain_tag,
+    }
+
+# Regexps used to parse the arguments of the size and color tags.
+size_tag_regexp = re.compile(r'(\+|-|)(\d+)')
+color_tag_regexp = re.compile(r'(\#?[a-fA-F0-9]+)')
+
+# Handlers for the tags that take an argument. Each is given the
+# TextStyle to change, the whole tag, and the argument.
+
+def font_tag(ts, tag, value):
+    ts.font = value
+
+def size_tag(ts, tag, value):
+
+    m = size_tag_regexp.match(value)
+
+    if not m:
+        raise Exception('Size tag %s could not be parsed.' % tag)
+
+    if m.group(1) == '+':
+        ts.size += int(m.group(2))
+    elif m.group(1) == '-':
+        ts.size -= int(m.group(2))
     else:
-        return greedy_text_layout(triples, width, style)
+        ts.size = int(m.group(2))
+
+def color_tag(ts, tag, value):
+
+    m = color_tag_regexp.match(value)
+
+    if not m:
+        raise Exception('Color tag %s could not be parsed.' % tag)
+
+    ts.color = color(m.group(1))
+
+# A map from the name of a tag that takes an argument (the part before
+# the =) to its handler.
+value_tags = {
+    "font" : font_tag,
+    "size" : size_tag,
+    "color" : color_tag,
+    }
 
 
 class Text(renpy.display.core.Displayable):
@@ -618,13 +1229,17 @@ class Text(renpy.display.core.Displayable):
     A displayable that can format and display text on the screen.
     """
 
-    nosave = [ 'laidout', 'laidout_lineheights', 'laidout_linewidths',
+    nosave = [ 'laidout', 'laidout_texts', 'laidout_lineheights', 'laidout_linewidths',
                'laidout_width', 'laidout_height', 'laidout_start',
                'laidout_length', 'laidout_hyperlinks', 'laidout_lines_last',
-               'width', 'tokens', 'children', 'child_pos']
+               'laidout_ascents', 'laidout_spacers',
+               'width', 'tokens', 'children', 'child_pos', 'laidout_key' ]
 
     __version__ = 2
 
+    # The layout key that self.laidout was computed for.
+    laidout_key = None
+
     def after_upgrade(self, version):
         if version <= 0:
             self.activated = None
@@ -711,7 +1326,6 @@ class Text(renpy.display.core.Displayable):
         set_text or set_style.
         """        
 
-        self.laidout = None
         self.child_pos = [ ]
         
         if self.text:
@@ -721,6 +1335,8 @@ class Text(renpy.display.core.Displayable):
 
         # Annoyingly, we can't tokenize until styles get built.
         if not renpy.style.styles_built:
+            self.laidout = None
+            self.laidout_key = None
             return
 
         if retokenize:
@@ -734,6 +1350,9 @@ class Text(renpy.display.core.Displayable):
         new_tokens = [ ]
         fasts = 0
 
+        # The indexes of the tags in new_tokens that control pausing.
+        pause_indexes = [ ]
+
         self.no_wait = False # W0201
         self.no_wait_once = False # W0201
         self.no_wait_done = False # W0201
@@ -743,8 +1362,9 @@ class Text(renpy.display.core.Displayable):
         for i in self.tokens[0]:
             type, text = i
             
-            if type == "tag":
+            if type == "tag" and (text in pause_tags or text[:2] in pause_tag_prefixes):
                 if text == "p":
+                    pause_indexes.append(len(new_tokens))
                     new_tokens.append(("tag", 'w'))
                     new_tokens.append(("newline", "\n"))
                     self.pauses += 1
@@ -752,7 +1372,8 @@ class Text(renpy.display.core.Displayable):
 
                     continue
 
-                elif text.startswith("p="):
+                elif text[:2] == "p=":
+                    pause_indexes.append(len(new_tokens))
                     new_tokens.append(("tag", 'w=' + text[2:]))
                     new_tokens.append(("newline", "\n"))
                     self.pauses += 1
@@ -773,9 +1394,11 @@ class Text(renpy.display.core.Displayable):
                     self.pauses += 1
                     self.pause_lengths.append(None)
 
-                elif text.startswith("w="):
+                elif text[:2] == "w=":
                     self.pauses += 1
                     self.pause_lengths.append(float(text[2:]))
+
+                pause_indexes.append(len(new_tokens))
                     
             new_tokens.append(i)
 
@@ -783,43 +1406,55 @@ class Text(renpy.display.core.Displayable):
 
         if self.pause is not None:
             pause = self.pause
-            new_tokens = [ ]
 
-            for i in self.tokens[0]:
-                new_tokens.append(i)
-                type, text = i
+            # Only the pause tags need to be examined to find where
+            # this pause ends.
+            end = len(new_tokens)
+            nws = [ ]
+
+            for index in pause_indexes:
+                text = new_tokens[index][1]
                 
-                if type == "tag":
-                    if text == "fast":
-                        fasts -= 1
-
-                    if text == "nw":
-                        new_tokens.pop()
-
-                    # If we have a fast to go, then ignore keep_pausing.
-                    if fasts:
-                        continue
-
-                    if text == "nw":
-                        self.no_wait_once = True
-                        break
-                        
-                    elif text == "w":
-
-                        if pause == 0:                                            
-                            self.keep_pausing |= True
-                            self.pause_length = None
-                            break                    
-                        else:
-                            pause -= 1
+                if text == "fast":
+                    fasts -= 1
 
-                    elif text[:2] == "w=":
-                        if pause == 0:
-                            self.keep_pausing |= True
-                            self.pause_length = float(text[2:])
-                            break                    
-                        else:
-                            pause -= 1
+                if text == "nw":
+                    nws.append(index)
+
+                # If we have a fast to go, then ignore keep_pausing.
+                if fasts:
+                    continue
+
+                if text == "nw":
+                    self.no_wait_once = True
+                    end = index
+                    break
+                    
+                elif text == "w":
+
+                    if pause == 0:                                            
+                        self.keep_pausing |= True
+                        self.pause_length = None
+                        end = index + 1
+                        break                    
+                    else:
+                        pause -= 1
+
+                elif text[:2] == "w=":
+                    if pause == 0:
+                        self.keep_pausing |= True
+                        self.pause_length = float(text[2:])
+                        end = index + 1
+                        break                    
+                    else:
+                        pause -= 1
+
+            new_tokens = new_tokens[:end]
+
+            # The nw tags are removed from the text.
+            for index in reversed(nws):
+                if index < end:
+                    del new_tokens[index]
 
             self.tokens[0] = new_tokens
 
@@ -841,12 +1476,10 @@ class Text(renpy.display.core.Displayable):
 
                 if kind == "tag" and i.startswith("image="):
 
-                    m = re.match(r'image=(.*)', i)
-
-                    if not m:
+                    if i == "image=":
                         raise Exception('Image tag %s could not be parsed.' % i)
 
-                    i = renpy.easy.displayable(m.group(1))
+                    i = renpy.easy.displayable(i[6:])
                     ntl.append(("widget", i))
                     self.children.append(i)
 
@@ -859,11 +1492,48 @@ class Text(renpy.display.core.Displayable):
             newtokens.append(ntl)
 
         self.tokens = newtokens
+
+        # Only throw away the layout if something it depends on has
+        # changed.
+        key = self.get_layout_key()
+
+        if key != self.laidout_key:
+            self.laidout = None
+            self.laidout_key = key
                     
         if redraw:
             renpy.display.render.redraw(self, 0)
 
 
+    def get_layout_key(self):
+        """
+        Returns a key that captures everything the layout of this
+        widget depends on, other than the width and the hyperlink
+        focus. (Changes to those clear self.laidout directly.)
+        """
+
+        style = self.style
+
+        # Widgets are keyed by identity, as different displayables can
+        # compare equal, and the layout has to use the same widgets as
+        # self.children. (A widget in the current layout can't have its
+        # id reused, since the layout keeps it alive.)
+        tokens = [ ]
+
+        for tl in self.tokens:
+            for kind, i in tl:
+                if kind == "widget":
+                    i = id(i)
+
+                tokens.append((kind, i))
+
+        return (tuple(tokens),
+                style.font, style.size, style.bold, style.italic,
+                style.underline, style.strikethrough, style.justify,
+                style.first_indent, style.rest_indent, style.layout,
+                style.subtitle_width, style.language, style.min_width,
+                style.line_spacing, renpy.config.rtl)
+
     def event(self, ev, x, y, st):
         """
         Space, Enter, or Click ends slow, if it's enabled.
@@ -916,35 +1586,41 @@ class Text(renpy.display.core.Displayable):
         This lays out the text of this widget. It sets self.laidout,
         self.laidout_lineheights, self.laidout_width, and
         self.laidout_height.
+
+        Each line is stored as two parallel lists: self.laidout has the
+        list of the styles of the spans in each line, and
+        self.laidout_texts the list of their text.
         """
 
-        if self.laidout and self.width == width:
+        if self.laidout is not None and self.width == width:
             return
 
         if self.tokens is None:
             self.update()
         
-        # Set this, so caching works.
+        # Set these, so caching works.
+        self.laidout = None
         self.width = width
 
         # We are building this list of triples, which will be passed
         # to text_layout.
         triples = [ ]
 
-        # text style list - a stack of text styles.
-        tsl = [ TextStyle() ]
-
         # The default style. (Duplicated in {a}, {st})
-        tsl[-1].font = self.style.font
-        tsl[-1].size = self.style.size
-        tsl[-1].bold = self.style.bold
-        tsl[-1].italic = self.style.italic
-        tsl[-1].underline = self.style.underline
-        tsl[-1].strikethrough = self.style.strikethrough
-        tsl[-1].color = None
-        tsl[-1].black_color = None
-        tsl[-1].hyperlink = None
-        tsl[-1].update()
+        ts = TextStyle()
+        ts.font = self.style.font
+        ts.size = self.style.size
+        ts.bold = self.style.bold
+        ts.italic = self.style.italic
+        ts.underline = self.style.underline
+        ts.strikethrough = self.style.strikethrough
+        ts.color = None
+        ts.black_color = None
+        ts.hyperlink = None
+        ts.update()
+
+        # text style list - a stack of text styles.
+        tsl = [ ts ]
 
         self.laidout_hyperlinks = [ ] # W0201
         
@@ -955,16 +1631,25 @@ class Text(renpy.display.core.Displayable):
 
         # for i in re.split(r'( |\{[^{}]+\}|\{\{|\n)', text):
 
-        tokens = [ ]
-        for l in self.tokens:
-            tokens.extend(l)
+        # The segments of tokens are chained together rather than being
+        # copied into a single list. The most common kinds of token are
+        # checked for first.
+        for kind, i in itertools.chain(*self.tokens):
 
-        ti = iter(tokens)
+            if kind == "word":
+                triples.append(("word", tsl[-1], i))
+                continue
 
-        for kind, i in ti:
+            elif kind == "space":
+                # Spaces always get appended to the end of a line. So they
+                # will never show up at the start of a line, unless they're
+                # after a newline or at the start of a string.
+
+                triples.append(("space", tsl[-1], i))
+                continue
 
             # Newline.
-            if kind == "newline":
+            elif kind == "newline":
                 triples.append(("newline", tsl[-1], ""))                
                 continue
 
@@ -999,13 +1684,12 @@ class Text(renpy.display.core.Displayable):
                     continue
                     
                 elif i.startswith("a="):
-                    m = re.match(r'a=(.*)', i)
-                    if not m:
+                    if i == "a=":
                         raise Exception('Hyperlink tag %s could not be parsed.' % i)
 
                     # TODO: check to see if we need to be focused.
 
-                    target = m.group(1)
+                    target = i[2:]
                     hls = renpy.config.hyperlink_styler(target)
 
                     old_prefix = hls.prefix
@@ -1021,17 +1705,18 @@ class Text(renpy.display.core.Displayable):
                     else:
                         hls.set_prefix("idle_")
                     
-                    tsl.append(TextStyle())
-                    tsl[-1].font = hls.font
-                    tsl[-1].size = hls.size
-                    tsl[-1].bold = hls.bold
-                    tsl[-1].italic = hls.italic
-                    tsl[-1].underline = hls.underline
-                    tsl[-1].strikethrough = hls.strikethrough
-                    tsl[-1].color = hls.color
-                    tsl[-1].black_color = hls.black_color
-                    tsl[-1].hyperlink = link
-                    tsl[-1].update()
+                    ts = TextStyle()
+                    ts.font = hls.font
+                    ts.size = hls.size
+                    ts.bold = hls.bold
+                    ts.italic = hls.italic
+                    ts.underline = hls.underline
+                    ts.strikethrough = hls.strikethrough
+                    ts.color = hls.color
+                    ts.black_color = hls.black_color
+                    ts.hyperlink = link
+                    ts.update()
+                    tsl.append(ts)
 
                     self.laidout_hyperlinks.append(target)
                     
@@ -1040,110 +1725,44 @@ class Text(renpy.display.core.Displayable):
                     continue
                     
                 # Otherwise, we're opening a new tag.
-                tsl.append(TextStyle(tsl[-1]))
-
-                if i == "b":
-                    tsl[-1].bold = True
-                    tsl[-1].update()
-
-                elif i == "i":
-                    tsl[-1].italic = True
-                    tsl[-1].update()
+                ts = TextStyle(tsl[-1])
+                tsl.append(ts)
 
-                elif i == "u":
-                    tsl[-1].underline = True
-                    tsl[-1].update()
+                handler = simple_tags.get(i, None)
 
-                elif i == "s":
-                    tsl[-1].strikethrough = True
-                    tsl[-1].update()
-
-                elif i == "plain":
-                    tsl[-1].bold = False
-                    tsl[-1].italic = False
-                    tsl[-1].underline = False
-                    tsl[-1].update()
+                if handler is not None:
+                    handler(ts)
+                    ts.update()
 
                 elif i[0] == "=":
                     style = getattr(renpy.store.style, i[1:])
 
-                    tsl[-1].font = style.font
-                    tsl[-1].size = style.size
-                    tsl[-1].bold = style.bold
-                    tsl[-1].italic = style.italic
-                    tsl[-1].underline = style.underline
-                    tsl[-1].strikethrough = style.strikethrough
-                    tsl[-1].color = style.color
-                    tsl[-1].black_color = style.black_color
-                    tsl[-1].update()
-
-
-                elif i.startswith("font"):
-
-                    m = re.match(r'font=(.*)', i)
-
-                    if not m:
-                        raise Exception('Font tag %s could not be parsed.' % i)
+                    ts.font = style.font
+                    ts.size = style.size
+                    ts.bold = style.bold
+                    ts.italic = style.italic
+                    ts.underline = style.underline
+                    ts.strikethrough = style.strikethrough
+                    ts.color = style.color
+                    ts.black_color = style.black_color
+                    ts.update()
 
-
-                    
-                    tsl[-1].font = m.group(1)
-                    tsl[-1].update()
-
-                elif i.startswith("size"):
-
-                    m = re.match(r'size=(\+|-|)(\d+)', i)
-
-                    if not m:
-                        raise Exception('Size tag %s could not be parsed.' % i)
-
-                    if m.group(1) == '+':
-                        tsl[-1].size += int(m.group(2))
-                    elif m.group(1) == '-':
-                        tsl[-1].size -= int(m.group(2))
-                    else:
-                        tsl[-1].size = int(m.group(2))                    
-                    tsl[-1].update()
-
-                elif i.startswith("color"):
-
-                    m = re.match(r'color=(\#?[a-fA-F0-9]+)', i)
-
-                    if not m:
-                        raise Exception('Color tag %s could not be parsed.' % i)
-
-                    tsl[-1].color = color(m.group(1))
-                    tsl[-1].update()
-                    
                 else:
-                    raise Exception("Text tag %s was not recognized. Case and spacing matter here." % i)
-
-                # Since the kind can change.
-                if kind == "tag":
-                    continue
-
-            elif kind == "space":
-                # Spaces always get appended to the end of a line. So they
-                # will never show up at the start of a line, unless they're
-                # after a newline or at the start of a string.
-
-                triples.append(("space", tsl[-1], i))
-                
-                continue
+                    name, eq, value = i.partition("=")
+                    handler = value_tags.get(name, None)
 
-            elif kind == "word":
-                triples.append(("word", tsl[-1], i))
+                    if handler is None or not eq:
+                        raise Exception("Text tag %s was not recognized. Case and spacing matter here." % i)
 
+                    handler(ts, i, value)
+                    ts.update()
 
             elif kind == "widget":
-                pass
+                wstyle = WidgetStyle(tsl[-1], i, width, time)
+                triples.append(("word", wstyle, i))
             
             else:
                 raise Exception("Unknown text token kind %s." % kind)
-
-            if kind == "widget":
-                wstyle = WidgetStyle(tsl[-1], i, width, time)
-                triples.append(("word", wstyle, i))
                             
         # We're done matching tags.
 
@@ -1158,100 +1777,93 @@ class Text(renpy.display.core.Displayable):
         # Now, we need to go through these lines, to generate the data
         # we need to render text.
 
-        self.laidout = [ ] # W0201
-        self.laidout_lineheights = [ ] # W0201
-        self.laidout_linewidths = [ ] # W0201
-        self.laidout_length = 0 # W0201
-        self.laidout_start = 0 # W0201
-        self.laidout_width = self.style.min_width # W0201
-        self.laidout_height = 0 # W0201
-        self.laidout_lines_last = lines_last # W0201
+        laidout = [ ]
+        laidout_texts = [ ]
+        laidout_lineheights = [ ]
+        laidout_linewidths = [ ]
+        laidout_ascents = [ ]
+        laidout_spacers = [ ]
+        laidout_length = 0
+        laidout_start = 0
+        laidout_width = self.style.min_width
+        laidout_height = 0
         
-        # Add something to empty lines.
-        for l in linetriples:
-            if not l:
-                l.append(('word', tsl[-1], ' '))
-
-
         justify = self.style.justify
+        line_spacing = self.style.line_spacing
+        rtl = renpy.config.rtl
                 
         for l in linetriples:
 
-            line = [ ]
-            oldts = None
-            cur = None
-            
-            for kind, ts, i in l:
-
-                if kind == "start":
-                    self.laidout_start = self.laidout_length
-                    continue
-
-                try:
-                    self.laidout_length += len(i)
-                except:
-                    self.laidout_length += ts.length(i)
-                    
-                if ts is not oldts:
-                    if oldts is not None:
-                        line.append((oldts, cur))
+            # Add something to empty lines.
+            if not l:
+                l = [ ('word', tsl[-1], ' ') ]
 
-                    oldts = ts
-                    cur = i
-                else:
-                    cur += i
+            styles, texts, length, start = coalesce_line(l, justify)
 
-                if justify and kind == "space":
-                    if cur:
-                        line.append((oldts, cur))
-                        cur = ""
-                    line.append((SpacerStyle(), ""))
-                    
-            if oldts:
-                line.append((oldts, cur))
+            if start is not None:
+                laidout_start = laidout_length + start
 
+            laidout_length += length
                 
-            if renpy.config.rtl:
+            # Lines without any right-to-left text come out of log2vis
+            # unchanged, so only the others need to go through it.
+            if rtl and line_needs_bidi(styles, texts):
 
-                rtl_line = [ ]
-                
                 # RTL direction.
                 line_direction = ON
 
-                for ts, i in line:
-                    if isinstance(ts, TextStyle):
-                        i, line_direction = log2vis(i, line_direction)
-
-                    rtl_line.append((ts, i))
+                for j, ts in enumerate(styles):
+                    if ts.kind == TEXT_KIND:
+                        texts[j], line_direction = log2vis(texts[j], line_direction)
 
                 if line_direction == RTL or line_direction == WRTL:
-                    rtl_line.reverse()
-
-                line = rtl_line
+                    styles.reverse()
+                    texts.reverse()
                 
             width = 0
             height = 0
+            max_ascent = 0
+            spacers = 0
 
-            for ts, i in line:
+            for ts, i in zip(styles, texts):
 
                 # This is a special case to handle mostly-blank lines introduced
                 # by newlines.
-                if len(line) == 1 and i == "":
+                if len(styles) == 1 and i == "":
                     i = " "
 
                 w, h = ts.sizes(i)
 
                 width += w
                 height = max(height, h)
+                max_ascent = max(ts.get_ascent(), max_ascent)
+
+                if ts.kind == SPACER_KIND:
+                    spacers += 1
 
-            self.laidout.append(line)
-            self.laidout_linewidths.append(width)
-            self.laidout_lineheights.append(height)
-            self.laidout_width = max(width, self.laidout_width)
-            self.laidout_height += height + self.style.line_spacing
+            laidout.append(styles)
+            laidout_texts.append(texts)
+            laidout_linewidths.append(width)
+            laidout_lineheights.append(height)
+            laidout_ascents.append(max_ascent)
+            laidout_spacers.append(spacers)
+            laidout_width = max(width, laidout_width)
+            laidout_height += height + line_spacing
 
             # For the newline.
-            self.laidout_length += 1
+            laidout_length += 1
+
+        self.laidout = laidout # W0201
+        self.laidout_texts = laidout_texts # W0201
+        self.laidout_lineheights = laidout_lineheights # W0201
+        self.laidout_linewidths = laidout_linewidths # W0201
+        self.laidout_ascents = laidout_ascents # W0201
+        self.laidout_spacers = laidout_spacers # W0201
+        self.laidout_length = laidout_length # W0201
+        self.laidout_start = laidout_start # W0201
+        self.laidout_width = laidout_width # W0201
+        self.laidout_height = laidout_height # W0201
+        self.laidout_lines_last = lines_last # W0201
 
 
     def get_simple_length(self):
@@ -1265,11 +1877,7 @@ class Text(renpy.display.core.Displayable):
 
         for tl in self.tokens:
             for type, text in tl:
-                if type == "newline":
-                    rv += len(text)
-                elif type == "word":
-                    rv += len(text)
-                elif type == "space":
+                if type in text_token_kinds:
                     rv += len(text)
                 elif type == "widget":
                     rv += 1
@@ -1294,10 +1902,14 @@ class Text(renpy.display.core.Displayable):
 
             
 
-    def render_pass(self, r, xo, yo, color, black_color, user_colors, length, time, at, child_pos, add_focus, expand):
+    def render_pass(self, r, passes, length, time, at, child_pos):
         """
-        Renders the text to r at the offsets. Color is the base color,
-        and user_colors controls if the user can override those colors.
+        Renders the text to r. Passes is a list of (xo, yo, color,
+        black_color, user_colors, expand) tuples, one for each time the
+        text is drawn, in the order they're drawn in. The last pass is
+        the main one, which adds focuses and the positions of
+        children. Each line is only walked once, with every pass drawn
+        as we go.
 
         Returns True if all characters were rendered, or False if a
         length restriction stopped some from being rendered.
@@ -1310,74 +1922,120 @@ class Text(renpy.display.core.Displayable):
         line_spacing = self.style.line_spacing
         text_align = self.style.text_align
         justify = self.style.justify
+        laidout_width = self.laidout_width
+
+        main = len(passes) - 1
+
+        # If the text isn't being shown slowly, there's no need to keep
+        # track of how much of it has been drawn.
+        limited = length < sys.maxint
 
-        for line, line_height, line_width, last in zip(self.laidout, self.laidout_lineheights, self.laidout_linewidths, self.laidout_lines_last):
+        # The blits (surface, pos) and focuses (None, args) of each pass.
+        # These are applied to r at the end, so that each pass is
+        # drawn entirely on top of the passes before it.
+        ops = [ [ ] for i in passes ]
+
+        rv = True
+        
+        laidout = self.laidout
+        laidout_texts = self.laidout_texts
+        laidout_lineheights = self.laidout_lineheights
+        laidout_linewidths = self.laidout_linewidths
+        laidout_lines_last = self.laidout_lines_last
+        laidout_ascents = self.laidout_ascents
+        laidout_spacers = self.laidout_spacers
+        
+        # The text_layout function may give more lines_last entries than
+        # lines, or fewer.
+        for lineno in xrange(min(len(laidout), len(laidout_lines_last))):
+            styles = laidout[lineno]
+            texts = laidout_texts[lineno]
+            line_height = laidout_lineheights[lineno]
+            line_width = laidout_linewidths[lineno]
+            last = laidout_lines_last[lineno]
+            max_ascent = laidout_ascents[lineno]
+            spacers = laidout_spacers[lineno]
+            
             if justify and not last:
-                empty_space = (self.laidout_width - line_width - indent)
+                empty_space = (laidout_width - line_width - indent)
                 x = indent
             else:
                 empty_space = 0
-                x = indent + text_align * (self.laidout_width - line_width)
+                x = indent + text_align * (laidout_width - line_width)
                 
             indent = rest_indent
-                
-            max_ascent = 0
-            spacers = 0
-                
-            for ts, text in line:
-                max_ascent = max(ts.get_ascent(), max_ascent)
 
-                if isinstance(ts, SpacerStyle):
-                    spacers += 1
+            # The x position of each pass.
+            xs = [ x ] * len(passes)
                 
-            for ts, text in line:
+            for spanno in xrange(len(styles)):
+                ts = styles[spanno]
+                text = texts[spanno]
 
-                if isinstance(ts, SpacerStyle):
+                if ts.kind == SPACER_KIND:
                     space = empty_space / spacers
-                    x += space
+                    xs = [ i + space for i in xs ]
                     empty_space -= space
                     spacers -= 1
                     continue
                     
-                length -= ts.length(text)
-
                 # Should we cache the rendered text?
                 use_cache = True
+
+                if limited:
+                    length -= ts.length(text)
                 
-                if length < 0:
-                    use_cache = False
+                    if length < 0:
+                        use_cache = False
                     
-                    if isinstance(text, (str, unicode)):
-                        text = text[:length]
-                    else:
-                        return False
-
-                surf, (sw, sh) = ts.render(text, antialias, color, black_color, user_colors, time, at, expand, use_cache)
+                        if ts.kind == TEXT_KIND:
+                            text = text[:length]
+                        else:
+                            rv = False
+                            break
 
-                if expand:
-                    (sw, sh) = ts.sizes(text)
-                    
                 actual_y = y + max_ascent - ts.get_ascent()
 
-                if surf:
-                    r.blit(surf, (x + xo, actual_y + yo))
+                for j, (xo, yo, color, black_color, user_colors, expand) in enumerate(passes):
+                
+                    surf, (sw, sh) = ts.render(text, antialias, color, black_color, user_colors, time, at, expand, use_cache)
+
+                    if expand:
+                        (sw, sh) = ts.sizes(text)
+
+                    x = xs[j]
+
+                    if surf:
+                        ops[j].append((surf, (x + xo, actual_y + yo)))
 
-                if add_focus and ts.hyperlink is not None:
-                    r.add_focus(self, ts.hyperlink, x + xo, y + yo, sw, sh)
+                    if j == main:
+                        if ts.hyperlink is not None:
+                            ops[j].append((None, (ts.hyperlink, x + xo, y + yo, sw, sh)))
 
-                if not isinstance(text, (str, unicode)):
-                    child_pos.append((text, x + xo, actual_y + yo))
+                        if ts.kind == WIDGET_KIND:
+                            child_pos.append((text, x + xo, actual_y + yo))
                 
-                x = x + sw
+                    xs[j] = x + sw
 
-                if length <= 0:
-                    return False
+                if limited and length <= 0:
+                    rv = False
+                    break
 
+            if not rv:
+                break
+                
             length -= 1
 
             y = y + line_height + line_spacing
 
-        return True
+        for l in ops:
+            for surf, args in l:
+                if surf is None:
+                    r.add_focus(self, *args)
+                else:
+                    r.blit(surf, args)
+            
+        return rv
 
     def call_slow_done(self, st):
         """
@@ -1433,17 +2091,21 @@ class Text(renpy.display.core.Displayable):
         maxdsx = 0
         maxdsy = 0
 
-        for dsx, dsy in dslist:
-            mindsx = min(mindsx, dsx)
-            mindsy = min(mindsy, dsy)
-            maxdsx = max(maxdsx, dsx)
-            maxdsy = max(maxdsy, dsy)
-
-        for expand, color, dsx, dsy in outlines:
-            mindsx = min(mindsx, dsx - expand)
-            mindsy = min(mindsy, dsy - expand)
-            maxdsx = max(maxdsx, dsx + expand)
-            maxdsy = max(maxdsy, dsy + expand)
+        # Most text has neither drop shadows nor outlines, in which case
+        # these all stay 0.
+        if dslist or outlines:
+
+            for dsx, dsy in dslist:
+                mindsx = min(mindsx, dsx)
+                mindsy = min(mindsy, dsy)
+                maxdsx = max(maxdsx, dsx)
+                maxdsy = max(maxdsy, dsy)
+
+            for expand, color, dsx, dsy in outlines:
+                mindsx = min(mindsx, dsx - expand)
+                mindsy = min(mindsy, dsy - expand)
+                maxdsx = max(maxdsx, dsx + expand)
+                maxdsy = max(maxdsy, dsy + expand)
             
         # minds{x,y} are negative (or 0), maxds{x,y} are positive (or 0).
             
@@ -1458,15 +2120,19 @@ class Text(renpy.display.core.Displayable):
 
         rv = renpy.display.render.Render(self.laidout_width - mindsx + maxdsx, self.laidout_height - mindsy + maxdsy)
 
+        passes = [ ]
+        
         for dsxo, dsyo in dslist:
-            self.render_pass(rv, dsxo - mindsx, dsyo - mindsy, self.style.drop_shadow_color, self.style.drop_shadow_color, False, length, st, at, [ ], False, 0)
+            passes.append((dsxo - mindsx, dsyo - mindsy, self.style.drop_shadow_color, self.style.drop_shadow_color, False, 0))
 
         for expand, color, dsxo, dsyo in outlines:
-            self.render_pass(rv, dsxo - mindsx - expand, dsyo - mindsy - expand, color, color, False, length, st, at, [ ], False, expand)
+            passes.append((dsxo - mindsx - expand, dsyo - mindsy - expand, color, color, False, expand))
+
+        passes.append((-mindsx, -mindsy, self.style.color, self.style.black_color, True, 0))
              
         self.child_pos = [ ]
 
-        if self.render_pass(rv, -mindsx, -mindsy, self.style.color, self.style.black_color, True, length, st, at, self.child_pos, True, 0):
+        if self.render_pass(rv, passes, length, st, at, self.child_pos):
             if self.slow:
                 self.call_slow_done(st)
 
@@ -1515,9 +2181,28 @@ class ParameterizedText(object):
     def predict(self, callback):
         return
     
+# This contains a map from (tokenizer, type, string) to the result of
+# checking the text tags in that string.
+check_cache = { }
+
 # This checks the text tags in a string to be sure they are all matched, and
 # properly nested. It returns an error message, or None if the line is okay.
 def check_text_tags(s):
+    key = (renpy.config.text_tokenizer, type(s), s)
+
+    if key in check_cache:
+        return check_cache[key]
+
+    rv = check_text_tags_uncached(s)
+
+    # Keep the cache from growing without bound.
+    if len(check_cache) > 4096:
+        check_cache.clear()
+
+    check_cache[key] = rv
+    return rv
+
+def check_text_tags_uncached(s):
     tokens = renpy.config.text_tokenizer(s, None)
 
     tag_stack = [ ]
@@ -1150,6 +1150,7 @@ def free_memory():
     force_full_redraw()
     renpy.display.im.free_memory()
     renpy.display.font.free_memory()
+    renpy.display.text.free_memory()
     renpy.display.render.free_memory()
 
 def easy_displayable(d, none=False):